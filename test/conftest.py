@@ -10,6 +10,7 @@ def pytest_configure(config):
     # register an additional marker (see pytest_collection_modifyitems)
     config.addinivalue_line("markers", "needs_cuda: mark for tests that rely on a CUDA device")
     config.addinivalue_line("markers", "dont_collect: mark for tests that should not be collected")
+    config.addinivalue_line("markers", "xdist_group: mark for tests that pytest-xdist should run on the same worker")
 
 
 def pytest_collection_modifyitems(items):
@@ -1,4 +1,9 @@
+import functools
 import importlib
+import itertools
+import sys
+from collections.abc import Mapping, Sequence
+from types import SimpleNamespace
 
 import pytest
 import test_models as TM
@@ -13,32 +18,73 @@ run_if_test_with_prototype = run_on_env_var(
     skip_reason="Prototype tests are disabled by default. Set PYTORCH_TEST_WITH_PROTOTYPE=1 to run them.",
 )
 
+_MODELS_BY_SUBMODULE = {
+    name: TM.get_models_from_module(module)
+    for name, module in [
+        ("models", models),
+        ("detection", models.detection),
+        ("quantization", models.quantization),
+        ("segmentation", models.segmentation),
+        ("video", models.video),
+        ("optical_flow", models.optical_flow),
+    ]
+}
+_ALL_MODEL_FNS = list(itertools.chain.from_iterable(_MODELS_BY_SUBMODULE.values()))
+
+
+@functools.lru_cache(maxsize=None)
+def _import_cached(name):
+    try:
+        return sys.modules[name]
+    except KeyError:
+        return importlib.import_module(name)
+
+
+@functools.lru_cache(maxsize=None)
+def _module_info(model_fn):
+    module_name = model_fn.__module__
+    parts = module_name.split(".")
+    return SimpleNamespace(
+        submodule=parts[-2],
+        parent=".".join(parts[:-1]),
+        original=module_name.replace(".prototype", ""),
+    )
+
 
 def _get_original_model(model_fn):
-    original_module_name = model_fn.__module__.replace(".prototype", "")
-    module = importlib.import_module(original_module_name)
+    module = _import_cached(_module_info(model_fn).original)
     return module.__dict__[model_fn.__name__]
 
 
 def _get_parent_module(model_fn):
-    parent_module_name = ".".join(model_fn.__module__.split(".")[:-1])
-    module = importlib.import_module(parent_module_name)
+    module = _import_cached(_module_info(model_fn).parent)
     return module
 
 
+@functools.lru_cache(maxsize=None)
+def _weights_index(module):
+    weights_name = "_QuantizedWeights" if module.__name__.split(".")[-1] == "quantization" else "_Weights"
+    return {k[: -len(weights_name)].lower(): v for k, v in module.__dict__.items() if k.endswith(weights_name)}
+
+
+@functools.lru_cache(maxsize=None)
 def _get_model_weights(model_fn):
     module = _get_parent_module(model_fn)
-    weights_name = "_QuantizedWeights" if module.__name__.split(".")[-1] == "quantization" else "_Weights"
-    try:
-        return next(
-            v
-            for k, v in module.__dict__.items()
-            if k.endswith(weights_name) and k.replace(weights_name, "").lower() == model_fn.__name__
-        )
-    except StopIteration:
-        return None
+    return _weights_index(module).get(model_fn.__name__)
+
+
+@functools.lru_cache(maxsize=None)
+def _cached_input(shape, dev):
+    if dev != "cpu":
+        # RNG always on CPU, to ensure x in cuda tests is bitwise identical to x in cpu tests
+        return _cached_input(shape, "cpu").to(device=dev)
+    return torch.rand(shape)
 
 
+# Holds the old and new models of the last comparison. This only pays off in local runs that cover both devices,
+# where the cuda run of a model reuses the models built for the cpu run instead of deserializing the checkpoints
+# again. In CI, the cpu and cuda tests never run in the same session, so the cache never hits there.
+@functools.lru_cache(maxsize=2)
 def _build_model(fn, **kwargs):
     try:
         model = fn(**kwargs)
@@ -69,15 +115,7 @@ def test_get_weight(name, weight):
     assert models.get_weight(name) == weight
 
 
-@pytest.mark.parametrize(
-    "model_fn",
-    TM.get_models_from_module(models)
-    + TM.get_models_from_module(models.detection)
-    + TM.get_models_from_module(models.quantization)
-    + TM.get_models_from_module(models.segmentation)
-    + TM.get_models_from_module(models.video)
-    + TM.get_models_from_module(models.optical_flow),
-)
+@pytest.mark.parametrize("model_fn", _ALL_MODEL_FNS)
 def test_naming_conventions(model_fn):
     weights_enum = _get_model_weights(model_fn)
     print(weights_enum)
@@ -85,68 +123,67 @@ def test_naming_conventions(model_fn):
     assert len(weights_enum) == 0 or hasattr(weights_enum, "default")
 
 
-@pytest.mark.parametrize(
-    "model_fn",
-    TM.get_models_from_module(models)
-    + TM.get_models_from_module(models.detection)
-    + TM.get_models_from_module(models.quantization)
-    + TM.get_models_from_module(models.segmentation)
-    + TM.get_models_from_module(models.video)
-    + TM.get_models_from_module(models.optical_flow),
-)
+_classification_fields = ["size", "categories", "acc@1", "acc@5"]
+_meta_fields_defaults = {
+    "all": ["interpolation", "recipe"],
+    "models": _classification_fields,
+    "detection": ["categories", "map"],
+    "quantization": _classification_fields + ["backend", "quantization", "unquantized"],
+    "segmentation": ["categories", "mIoU", "acc"],
+    "video": _classification_fields,
+    "optical_flow": [],
+}
+_FIELDS_BY_MODULE = {
+    module_name: frozenset(_meta_fields_defaults["all"] + fields)
+    for module_name, fields in _meta_fields_defaults.items()
+    if module_name != "all"
+}
+
+
+@pytest.mark.parametrize("model_fn", _ALL_MODEL_FNS)
 def test_schema_meta_validation(model_fn):
-    classification_fields = ["size", "categories", "acc@1", "acc@5"]
-    defaults = {
-        "all": ["interpolation", "recipe"],
-        "models": classification_fields,
-        "detection": ["categories", "map"],
-        "quantization": classification_fields + ["backend", "quantization", "unquantized"],
-        "segmentation": ["categories", "mIoU", "acc"],
-        "video": classification_fields,
-        "optical_flow": [],
-    }
-    module_name = model_fn.__module__.split(".")[-2]
-    fields = set(defaults["all"] + defaults[module_name])
+    module_name = _module_info(model_fn).submodule
+    fields = _FIELDS_BY_MODULE[module_name]
 
     weights_enum = _get_model_weights(model_fn)
 
     problematic_weights = {}
     for w in weights_enum:
-        missing_fields = fields - set(w.meta.keys())
+        missing_fields = fields.difference(w.meta)
         if missing_fields:
             problematic_weights[w] = missing_fields
 
     assert not problematic_weights
 
 
-@pytest.mark.parametrize("model_fn", TM.get_models_from_module(models))
+@pytest.mark.parametrize("model_fn", _MODELS_BY_SUBMODULE["models"])
 @pytest.mark.parametrize("dev", cpu_and_gpu())
 @run_if_test_with_prototype
 def test_classification_model(model_fn, dev):
     TM.test_classification_model(model_fn, dev)
 
 
-@pytest.mark.parametrize("model_fn", TM.get_models_from_module(models.detection))
+@pytest.mark.parametrize("model_fn", _MODELS_BY_SUBMODULE["detection"])
 @pytest.mark.parametrize("dev", cpu_and_gpu())
 @run_if_test_with_prototype
 def test_detection_model(model_fn, dev):
     TM.test_detection_model(model_fn, dev)
 
 
-@pytest.mark.parametrize("model_fn", TM.get_models_from_module(models.quantization))
+@pytest.mark.parametrize("model_fn", _MODELS_BY_SUBMODULE["quantization"])
 @run_if_test_with_prototype
 def test_quantized_classification_model(model_fn):
     TM.test_quantized_classification_model(model_fn)
 
 
-@pytest.mark.parametrize("model_fn", TM.get_models_from_module(models.segmentation))
+@pytest.mark.parametrize("model_fn", _MODELS_BY_SUBMODULE["segmentation"])
 @pytest.mark.parametrize("dev", cpu_and_gpu())
 @run_if_test_with_prototype
 def test_segmentation_model(model_fn, dev):
     TM.test_segmentation_model(model_fn, dev)
 
 
-@pytest.mark.parametrize("model_fn", TM.get_models_from_module(models.video))
+@pytest.mark.parametrize("model_fn", _MODELS_BY_SUBMODULE["video"])
 @pytest.mark.parametrize("dev", cpu_and_gpu())
 @run_if_test_with_prototype
 def test_video_model(model_fn, dev):
@@ -154,52 +191,93 @@ def test_video_model(model_fn, dev):
 
 
 @needs_cuda
-@pytest.mark.parametrize("model_builder", TM.get_models_from_module(models.optical_flow))
+@pytest.mark.parametrize("model_builder", _MODELS_BY_SUBMODULE["optical_flow"])
 @pytest.mark.parametrize("scripted", (False, True))
 @run_if_test_with_prototype
 def test_raft(model_builder, scripted):
     TM.test_raft(model_builder, scripted)
 
 
+def _outputs_equal(actual, expected):
+    if isinstance(actual, torch.Tensor):
+        return (
+            isinstance(expected, torch.Tensor)
+            and actual.dtype == expected.dtype
+            and actual.shape == expected.shape
+            and torch.equal(actual, expected)
+        )
+    if isinstance(actual, Mapping):
+        return (
+            isinstance(expected, Mapping)
+            and actual.keys() == expected.keys()
+            and all(_outputs_equal(actual[k], expected[k]) for k in actual)
+        )
+    if isinstance(actual, Sequence) and not isinstance(actual, str):
+        return (
+            isinstance(expected, Sequence)
+            and len(actual) == len(expected)
+            and all(_outputs_equal(a, e) for a, e in zip(actual, expected))
+        )
+    return False
+
+
+def _assert_outputs_equal(actual, expected):
+    # torch.equal bails out on the first mismatch and skips the diagnostics of assert_close, which we only need if
+    # the outputs actually differ
+    if not _outputs_equal(actual, expected):
+        torch.testing.assert_close(actual, expected, rtol=0.0, atol=0.0, check_dtype=False)
+
+
+_factory_defaults = {
+    "models": {
+        "input_shape": (1, 3, 224, 224),
+    },
+    "detection": {
+        "input_shape": (3, 300, 300),
+    },
+    "quantization": {
+        "input_shape": (1, 3, 224, 224),
+        "quantize": True,
+    },
+    "segmentation": {
+        "input_shape": (1, 3, 520, 520),
+    },
+    "video": {
+        "input_shape": (1, 3, 4, 112, 112),
+    },
+    "optical_flow": {
+        "input_shape": (1, 3, 128, 128),
+    },
+}
+
+
+def _make_factory_kwargs(model_fn):
+    module_name = _module_info(model_fn).submodule
+    kwargs = {"pretrained": True, **_factory_defaults[module_name], **TM._model_params.get(model_fn.__name__, {})}
+    input_shape = kwargs.pop("input_shape")
+    kwargs.pop("num_classes", None)  # ignore this as it's an incompatible speed optimization for pre-trained models
+    return kwargs, input_shape
+
+
+_KWARGS_BY_FN = {model_fn: _make_factory_kwargs(model_fn) for model_fn in _ALL_MODEL_FNS}
+
+
+@pytest.mark.parametrize("dev", cpu_and_gpu())
 @pytest.mark.parametrize(
     "model_fn",
-    TM.get_models_from_module(models)
-    + TM.get_models_from_module(models.detection)
-    + TM.get_models_from_module(models.quantization)
-    + TM.get_models_from_module(models.segmentation)
-    + TM.get_models_from_module(models.video)
-    + TM.get_models_from_module(models.optical_flow),
+    # When running with pytest-xdist and --dist loadgroup, all devices of a model are sent to the same worker so they
+    # can share the models cached by _build_model
+    [
+        pytest.param(model_fn, marks=pytest.mark.xdist_group(f"{model_fn.__module__}.{model_fn.__name__}"))
+        for model_fn in _ALL_MODEL_FNS
+    ],
 )
-@pytest.mark.parametrize("dev", cpu_and_gpu())
 @run_if_test_with_prototype
 def test_old_vs_new_factory(model_fn, dev):
-    defaults = {
-        "models": {
-            "input_shape": (1, 3, 224, 224),
-        },
-        "detection": {
-            "input_shape": (3, 300, 300),
-        },
-        "quantization": {
-            "input_shape": (1, 3, 224, 224),
-            "quantize": True,
-        },
-        "segmentation": {
-            "input_shape": (1, 3, 520, 520),
-        },
-        "video": {
-            "input_shape": (1, 3, 4, 112, 112),
-        },
-        "optical_flow": {
-            "input_shape": (1, 3, 128, 128),
-        },
-    }
     model_name = model_fn.__name__
-    module_name = model_fn.__module__.split(".")[-2]
-    kwargs = {"pretrained": True, **defaults[module_name], **TM._model_params.get(model_name, {})}
-    input_shape = kwargs.pop("input_shape")
-    kwargs.pop("num_classes", None)  # ignore this as it's an incompatible speed optimization for pre-trained models
-    x = torch.rand(input_shape).to(device=dev)
+    module_name = _module_info(model_fn).submodule
+    kwargs, input_shape = _KWARGS_BY_FN[model_fn]
+    x = _cached_input(input_shape, dev)
     if module_name == "detection":
         x = [x]
 
@@ -210,11 +288,18 @@ def test_old_vs_new_factory(model_fn, dev):
 
     # compare with new model builder parameterized in the old fashion way
     try:
-        model_old = _build_model(_get_original_model(model_fn), **kwargs).to(device=dev)
-        model_new = _build_model(model_fn, **kwargs).to(device=dev)
+        original_model_fn = _get_original_model(model_fn)
     except ModuleNotFoundError:
         pytest.skip(f"Model '{model_name}' not available in both modules.")
-    torch.testing.assert_close(model_new(*args), model_old(*args), rtol=0.0, atol=0.0, check_dtype=False)
+    if original_model_fn is model_fn:
+        pytest.skip(f"Model '{model_name}' shares its implementation in both modules.")
+
+    model_old = _build_model(original_model_fn, **kwargs).to(device=dev)
+    model_new = _build_model(model_fn, **kwargs).to(device=dev)
+    with torch.inference_mode():
+        out_new = model_new(*args)
+        out_old = model_old(*args)
+    _assert_outputs_equal(out_new, out_old)
 
 
 def test_smoke():
@@ -227,6 +312,14 @@ class TestHandleLegacyInterface:
     class ModelWeights(WeightsEnum):
         Sentinel = Weights(url="https://pytorch.org", transforms=lambda x: x, meta=dict())
 
+    @pytest.fixture(scope="class")
+    def builder(self):
+        @handle_legacy_interface(weights=("pretrained", self.ModelWeights.Sentinel))
+        def builder(*, weights=None):
+            pass
+
+        return builder
+
     @pytest.mark.parametrize(
         "kwargs",
         [
@@ -235,38 +328,22 @@ class TestHandleLegacyInterface:
             pytest.param(dict(weights=ModelWeights.Sentinel), id="Weights"),
         ],
     )
-    def test_no_warn(self, kwargs):
-        @handle_legacy_interface(weights=("pretrained", self.ModelWeights.Sentinel))
-        def builder(*, weights=None):
-            pass
-
+    def test_no_warn(self, builder, kwargs):
         builder(**kwargs)
 
     @pytest.mark.parametrize("pretrained", (True, False))
-    def test_pretrained_pos(self, pretrained):
-        @handle_legacy_interface(weights=("pretrained", self.ModelWeights.Sentinel))
-        def builder(*, weights=None):
-            pass
-
+    def test_pretrained_pos(self, builder, pretrained):
         with pytest.warns(UserWarning, match="positional"):
             builder(pretrained)
 
     @pytest.mark.parametrize("pretrained", (True, False))
-    def test_pretrained_kw(self, pretrained):
-        @handle_legacy_interface(weights=("pretrained", self.ModelWeights.Sentinel))
-        def builder(*, weights=None):
-            pass
-
+    def test_pretrained_kw(self, builder, pretrained):
         with pytest.warns(UserWarning, match="deprecated"):
             builder(pretrained)
 
     @pytest.mark.parametrize("pretrained", (True, False))
     @pytest.mark.parametrize("positional", (True, False))
-    def test_equivalent_behavior_weights(self, pretrained, positional):
-        @handle_legacy_interface(weights=("pretrained", self.ModelWeights.Sentinel))
-        def builder(*, weights=None):
-            pass
-
+    def test_equivalent_behavior_weights(self, builder, pretrained, positional):
         args, kwargs = ((pretrained,), dict()) if positional else ((), dict(pretrained=pretrained))
         with pytest.warns(UserWarning, match=f"weights={self.ModelWeights.Sentinel if pretrained else None}"):
             builder(*args, **kwargs)